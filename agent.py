@@ -4,15 +4,34 @@ Multi-agent orchestrator for MedAgent.
 - Loads GOOGLE_API_KEY from .env
 - Uses google.generativeai (Gemini) for agent responses
 - Implements short-term memory per agent and persistent logs saved to diagnosis_logs/
+- Semantic response cache (Gemini embeddings) skips repeat calls for near-duplicate reports
 - Agents: GeneralPhysician, Cardiologist, Pulmonologist, Psychologist, Neurologist, MultidisciplinaryTeam
 """
 
 import os
 import json
+import re
+import asyncio
 import datetime
+import time
+import hashlib
+import queue
+import atexit
+import collections
+import functools
+import threading
+import logging
+import warnings
 from pathlib import Path
+from types import MappingProxyType
+from typing import Final
+import numpy as np
+import orjson
 from dotenv import load_dotenv
 import google.generativeai as genai
+from google.generativeai import caching
+
+logger = logging.getLogger(__name__)
 
 # Load environment
 load_dotenv()
@@ -20,125 +39,538 @@ API_KEY = os.getenv("GOOGLE_API_KEY")
 if not API_KEY:
     raise ValueError("GOOGLE_API_KEY not set in .env")
 
-genai.configure(api_key=API_KEY)
+# gRPC keeps one persistent HTTP/2 channel that the concurrent agent calls multiplex over
+genai.configure(api_key=API_KEY, transport="grpc")
 MODEL_NAME = "gemini-2.5-flash"
 model = genai.GenerativeModel(MODEL_NAME)
 
+# Model tiers: cheap model for simple presentations, pro reserved for complex MDT synthesis
+MODEL_TIERS = {
+    "lite": "gemini-2.5-flash-lite",
+    "standard": MODEL_NAME,
+    "pro": "gemini-2.5-pro",
+}
+
+RED_FLAG_RE = re.compile(
+    r"syncope|faint|hemoptysis|haemoptysis|coughing (up )?blood|focal deficit|chest pain radiating|"
+    r"radiating to (the )?(left )?(arm|jaw)|seizure|slurred speech|one-sided weakness|suicid",
+    re.IGNORECASE,
+)
+TRIVIAL_RE = re.compile(
+    r"common cold|runny nose|blocked nose|sneez|sore throat|mild cough|mild fever|seasonal allerg",
+    re.IGNORECASE,
+)
+
+# Concerns that rule out the cheap tier even when a benign term is also present
+CONCERN_RE = re.compile(
+    r"chest (pain|tightness|pressure)|crushing|dyspn|shortness of breath|short of breath|breathless|"
+    r"palpitation|headache|dizz|vertigo|numbness|tingling|confusion|wheez|high fever|"
+    r"sweating|vomiting|abdominal pain|weight loss|depress|anxiety",
+    re.IGNORECASE,
+)
+
+def _triage_complexity(report_text: str) -> str:
+    """
+    Keyword scan returning 'trivial', 'standard' or 'complex'; red flags always win.
+    'trivial' needs a benign term and no standard-level concern anywhere in the report.
+    """
+    if RED_FLAG_RE.search(report_text):
+        return "complex"
+    if TRIVIAL_RE.search(report_text) and not CONCERN_RE.search(report_text):
+        return "trivial"
+    return "standard"
+
 # persistent logs directory
 LOG_DIR = Path("diagnosis_logs")
 LOG_DIR.mkdir(parents=True, exist_ok=True)
+# plain-string prefix so per-session log paths are built without Path objects
+LOG_DIR_STR = str(LOG_DIR.resolve()) + os.sep
+
+# Logs are written by a background thread so the workflow returns without waiting on disk
+LOG_QUEUE = queue.Queue(maxsize=256)
+
+def _log_writer():
+    while True:
+        path, log = LOG_QUEUE.get()
+        try:
+            # orjson returns the whole document as bytes, so it goes out in a single write()
+            data = orjson.dumps(log, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+            # write a temp file and swap it in, so readers never see a partial log
+            tmp_path = f"{path}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
+            os.replace(tmp_path, path)
+        except Exception:
+            # keep the writer alive: a dead thread would stall LOG_QUEUE.put once the queue fills
+            logger.exception("failed to write diagnosis log %s", path)
+        finally:
+            LOG_QUEUE.task_done()
+
+threading.Thread(target=_log_writer, name="medagent-log-writer", daemon=True).start()
+# flush pending logs before the interpreter exits
+atexit.register(LOG_QUEUE.join)
+
+def format_log_txt(log: dict) -> str:
+    """Render a JSON diagnosis log as the human-readable TXT report."""
+    lines = [
+        "=== MedAgent Diagnosis Log ===\n",
+        f"Session ID: {log['session_id']}\nTimestamp: {log['timestamp']}\n\n",
+        "=== Report ===\n",
+        log["report_text"] + "\n\n",
+    ]
+    for k, v in log["outputs"].items():
+        lines.append(f"--- {k} ---\n")
+        lines.append(v + "\n\n")
+    return "".join(lines)
+
+EMBED_MODEL_NAME = "models/text-embedding-004"
+
+# Demographic header written by app.py ("Patient: <name>, Age: <age>, Gender: <gender>. ...")
+_HEADER_RE = re.compile(r"^\s*Patient:\s*(.*?),\s*Age:\s*(.*?),\s*Gender:\s*(.*?)\.")
+
+def _patient_key(report_text: str) -> int:
+    """
+    64-bit hash of the report's patient header, falling back to the whole report when there is none.
+    Cached answers are only reused for an identical key, so near-identical reports for
+    different patients never share an answer.
+    """
+    m = _HEADER_RE.match(report_text)
+    basis = "\x1f".join(g.strip() for g in m.groups()) if m else report_text
+    return int.from_bytes(hashlib.sha256(basis.encode("utf-8")).digest()[:8], "little", signed=True)
+
+# Semantic cache: reuse an agent's earlier answer when a new report is near-identical
+class SemanticCache:
+    def __init__(self, path: Path, threshold: float = 0.95, max_entries: int = 10000, save_interval: float = 60.0):
+        self.path = Path(path)
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.save_interval = save_interval
+        # per agent name: {"emb": (capacity, d) float32 matrix, "texts": [str], "used": (capacity,) int64 LRU ticks,
+        # "keys": (capacity,) int64 patient keys}; only the first len(texts) rows are live, the rest is
+        # preallocated room to grow
+        self.entries = {}
+        self._tick = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+        try:
+            self._load()
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.exception("could not load semantic cache %s; starting empty", self.path)
+            self.entries, self._tick = {}, 0
+
+    # On disk: <path>.npz holds the numeric arrays (loaded with allow_pickle=False, so loading
+    # cannot run code) and <path>.json holds the texts; a shared token ties the two files together.
+    def _load(self):
+        with open(self.path.with_suffix(".json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with np.load(self.path.with_suffix(".npz"), allow_pickle=False) as arrays:
+            if int(arrays["token"]) != meta["token"]:
+                raise ValueError("cache .npz and .json are from different saves")
+            entries = {}
+            for i, agent in enumerate(meta["agents"]):
+                texts = list(agent["texts"])
+                emb = arrays[f"emb_{i}"].astype(np.float32, copy=False)
+                used = arrays[f"used_{i}"].astype(np.int64, copy=False)
+                keys = arrays[f"keys_{i}"].astype(np.int64, copy=False)
+                if not (len(texts) == emb.shape[0] == used.shape[0] == keys.shape[0]):
+                    raise ValueError(f"cache entry {agent['name']!r} has mismatched lengths")
+                entries[agent["name"]] = {"emb": emb, "texts": texts, "used": used, "keys": keys}
+        self.entries, self._tick = entries, int(meta["tick"])
+
+    @staticmethod
+    def embed(text: str) -> np.ndarray:
+        vec = np.asarray(genai.embed_content(model=EMBED_MODEL_NAME, content=text)["embedding"], dtype=np.float32)
+        # unit-normalize so a dot product is the cosine similarity
+        return vec / (np.linalg.norm(vec) or 1.0)
+
+    def lookup(self, agent_name: str, query: np.ndarray, key: int):
+        with self._lock:
+            entry = self.entries.get(agent_name)
+            if not entry or not entry["texts"]:
+                return None
+            n = len(entry["texts"])
+            # similarity alone is not enough: only rows for the same patient header may hit
+            same = entry["keys"][:n] == key
+            if not same.any():
+                return None
+            sims = np.where(same, entry["emb"][:n] @ query, -np.inf)
+            best = int(np.argmax(sims))
+            if sims[best] <= self.threshold:
+                return None
+            self._tick += 1
+            entry["used"][best] = self._tick
+            return entry["texts"][best]
+
+    def add(self, agent_name: str, query: np.ndarray, key: int, text: str):
+        with self._lock:
+            self._tick += 1
+            self._dirty = True
+            entry = self.entries.get(agent_name)
+            if entry is None:
+                entry = self.entries[agent_name] = {
+                    "emb": np.empty((16, query.shape[0]), dtype=np.float32),
+                    "texts": [],
+                    "used": np.zeros(16, dtype=np.int64),
+                    "keys": np.zeros(16, dtype=np.int64),
+                }
+            n = len(entry["texts"])
+            if n >= self.max_entries:
+                # overwrite the least recently used row in place
+                victim = int(np.argmin(entry["used"][:n]))
+                entry["emb"][victim] = query
+                entry["texts"][victim] = text
+                entry["used"][victim] = self._tick
+                entry["keys"][victim] = key
+                return
+            if n == entry["emb"].shape[0]:
+                # grow geometrically so inserts are amortized O(1) instead of copying every time
+                cap = min(max(2 * n, 16), self.max_entries)
+                emb = np.empty((cap, entry["emb"].shape[1]), dtype=np.float32)
+                emb[:n] = entry["emb"][:n]
+                used = np.zeros(cap, dtype=np.int64)
+                used[:n] = entry["used"][:n]
+                keys = np.zeros(cap, dtype=np.int64)
+                keys[:n] = entry["keys"][:n]
+                entry["emb"], entry["used"], entry["keys"] = emb, used, keys
+            entry["emb"][n] = query
+            entry["used"][n] = self._tick
+            entry["keys"][n] = key
+            entry["texts"].append(text)
+
+    def save(self):
+        """Persist the cache if it changed; serialization happens outside the lock and files are replaced atomically."""
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = {
+                name: {
+                    "emb": e["emb"][:len(e["texts"])].copy(),
+                    "texts": list(e["texts"]),
+                    "used": e["used"][:len(e["texts"])].copy(),
+                    "keys": e["keys"][:len(e["texts"])].copy(),
+                }
+                for name, e in self.entries.items()
+            }
+            tick = self._tick
+            self._dirty = False
+        token = time.time_ns()
+        names = list(snapshot)
+        meta = {"token": token, "tick": tick, "agents": [{"name": n, "texts": snapshot[n]["texts"]} for n in names]}
+        arrays = {"token": np.int64(token)}
+        for i, n in enumerate(names):
+            arrays[f"emb_{i}"] = snapshot[n]["emb"]
+            arrays[f"used_{i}"] = snapshot[n]["used"]
+            arrays[f"keys_{i}"] = snapshot[n]["keys"]
+        npz_path, json_path = self.path.with_suffix(".npz"), self.path.with_suffix(".json")
+        try:
+            # write both to temp files, then swap each into place atomically
+            with open(f"{npz_path}.tmp", "wb") as f:
+                np.savez(f, **arrays)
+            with open(f"{json_path}.tmp", "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(f"{npz_path}.tmp", npz_path)
+            os.replace(f"{json_path}.tmp", json_path)
+        except Exception:
+            self._dirty = True  # retry on the next save
+            logger.exception("failed to save semantic cache %s", self.path)
+
+    def _autosave(self):
+        while True:
+            time.sleep(self.save_interval)
+            self.save()
+
+    def start_autosave(self):
+        """Save in the background every save_interval seconds, and once more at exit."""
+        threading.Thread(target=self._autosave, name="medagent-cache-saver", daemon=True).start()
+        atexit.register(self.save)
+
+response_cache = SemanticCache(LOG_DIR / "semantic_cache")
+response_cache.start_autosave()
+
+# Explicit context caches have a minimum size (about 1024 tokens on 2.5 models),
+# so only long reports are uploaded once and shared by the specialists.
+# ~4 chars/token puts the minimum near 4k chars; 8k leaves margin for token-dense text.
+REPORT_CACHE_MIN_CHARS = 8192
+
+def _create_report_cache(report_text: str, tier: str):
+    """Upload the report as a short-lived CachedContent, or return None to send it inline."""
+    if len(report_text) < REPORT_CACHE_MIN_CHARS:
+        return None
+    try:
+        return caching.CachedContent.create(
+            model=f"models/{MODEL_TIERS[tier]}",
+            contents=[report_text],
+            ttl=datetime.timedelta(minutes=10),
+        )
+    except Exception:
+        logger.exception("could not create shared report cache; sending the report inline")
+        return None
+
+# UI agent keys -> display names used in follow-up prompts
+_AGENT_NAMES: Final = MappingProxyType({
+    "gp": "General Physician",
+    "cardio": "Cardiologist",
+    "pulmo": "Pulmonologist",
+    "psych": "Psychologist",
+    "neuro": "Neurologist",
+    "final": "Multidisciplinary Team",
+})
+
+SPECIALISTS = ("Cardiologist", "Pulmonologist", "Psychologist", "Neurologist")
+NOT_CONSULTED = "(not consulted)"
+# Case-sensitive on purpose: prose such as "Refer: to ED" must not be read as the referral line
+REFER_RE = re.compile(r"^[\s*_]*REFER[\s*_]*:(.*)$", re.MULTILINE)
+
+def _referred_specialists(gp_out: str) -> tuple:
+    """
+    Specialists named on the GP's last 'REFER:' line.
+    Returns () only for an explicit 'REFER: None'; a missing or unparseable line consults everyone.
+    """
+    lines = REFER_RE.findall(gp_out)
+    if not lines:
+        return SPECIALISTS
+    line = lines[-1].strip(" *_.").lower()
+    if line == "none":
+        return ()
+    named = tuple(k for k in SPECIALISTS if k.lower() in line)
+    return named or SPECIALISTS
+
+# Flattens line breaks in one-line memory summaries
+_NL_TRANS = str.maketrans({"\n": " ", "\r": " "})
 
 # Small in-memory per-agent short-term memory implementation
 class MedicalAgent:
-    def __init__(self, name: str, role_prompt: str):
+    def __init__(self, name: str, role_prompt: str, use_cache: bool = True):
         self.name = name
         self.role_prompt = role_prompt.strip()
+        self.use_cache = use_cache  # consult/populate the semantic response cache
         self.memory = []  # short-term memory (list of strings)
+        # Static instructions go in the system instruction so every request starts with the
+        # same prefix, which Gemini's implicit prompt cache can reuse across calls
+        self._system = (
+            f"You are a medical specialist: {self.name}.\n{self.role_prompt}\n\n"
+            "Provide a clear concise analysis, key findings, recommended next steps, tests (if any), and urgency level.\n"
+        )
+        self._prefix = "Patient report and context:\n"
+        self.models = {
+            tier: genai.GenerativeModel(name, system_instruction=self._system)
+            for tier, name in MODEL_TIERS.items()
+        }
 
-    def _build_prompt(self, report_text: str):
-        # Compose prompt including short-term memory (most recent items)
-        memory_text = ""
+    def _build_prompt(self, report_text: str, shared_report: bool = False):
+        # Only the report and memory change between calls (static text lives in self._system)
+        if shared_report:
+            # report lives in the cached context; a cached-content model has no system instruction
+            parts = [self._system, "\nThe patient report is provided in the cached context."]
+        else:
+            parts = [self._prefix, report_text]
         if self.memory:
             # include only last few entries to keep prompt short
-            memory_text = "\n\nShort-term memory (latest):\n" + "\n".join(self.memory[-6:])
-        prompt = (
-            f"You are a medical specialist: {self.name}.\n"
-            f"{self.role_prompt}\n\n"
-            f"Patient report and context:\n{report_text}\n\n"
-            f"{memory_text}\n\n"
-            f"Provide a clear concise analysis, key findings, recommended next steps, tests (if any), and urgency level.\n"
-        )
-        return prompt
+            parts.append("\n\nShort-term memory (latest):\n")
+            parts.append("\n".join(self.memory[-6:]))
+        return "".join(parts)
 
-    def analyze(self, report_text: str) -> str:
-        prompt = self._build_prompt(report_text)
-        # Call Gemini
-        response = model.generate_content(prompt)
+    def probe_cache(self, report_text: str):
+        """
+        Return (query embedding, patient key, cached answer or None) for this agent and report.
+        Fails open: if caching is off or embedding fails, returns (None, None, None) and the caller just calls Gemini.
+        """
+        if not self.use_cache:
+            return None, None, None
+        try:
+            # Cache key is the report plus this agent's role, not the (changing) memory
+            query = response_cache.embed(report_text + "\n" + self.role_prompt)
+            key = _patient_key(report_text)
+            return query, key, response_cache.lookup(self.name, query, key)
+        except Exception:
+            logger.exception("semantic cache probe failed for %s; calling the model directly", self.name)
+            return None, None, None
+
+    def _generate(self, report_text: str, tier: str = "standard", report_cache=None, probe=None) -> str:
+        query, key, cached = probe if probe is not None else self.probe_cache(report_text)
+        if cached is not None:
+            return cached
+        if report_cache is not None:
+            gen_model = genai.GenerativeModel.from_cached_content(report_cache)
+        else:
+            gen_model = self.models[tier]
+        response = gen_model.generate_content(self._build_prompt(report_text, report_cache is not None))
         text = response.text.strip()
+        if query is not None:
+            response_cache.add(self.name, query, key, text)
+        return text
+
+    def _remember(self, text: str, ts: str = None):
         # Save into short-term memory (we store agent name + brief summary)
         # For memory, keep a one-line summary (first 240 chars) to avoid long contexts
-        summary_line = f"[{datetime.datetime.now().isoformat()}] {self.name} summary: {text[:240].replace('\\n', ' ')}"
+        # ts is normally formatted once per workflow by the orchestrator
+        if ts is None:
+            ts = datetime.datetime.now().isoformat()
+        snippet = text[:240]
+        if "\n" in snippet or "\r" in snippet:
+            snippet = snippet.translate(_NL_TRANS)
+        summary_line = f"[{ts}] {self.name} summary: {snippet}"
         self.memory.append(summary_line)
         # Cap memory to last 50 entries
         if len(self.memory) > 50:
             self.memory = self.memory[-50:]
+
+    async def analyze_async(self, report_text: str, tier: str = "standard", ts: str = None, report_cache=None, probe=None) -> str:
+        # Call Gemini in a worker thread so several agents can wait on the network at once
+        text = await asyncio.to_thread(self._generate, report_text, tier, report_cache, probe)
+        self._remember(text, ts)
         return text
 
+    def analyze_stream(self, report_text: str, tier: str = "standard", ts: str = None):
+        """Yield the response text chunk by chunk as Gemini produces it."""
+        query, key, cached = self.probe_cache(report_text)
+        if cached is not None:
+            yield cached
+            self._remember(cached, ts)
+            return
+        parts = []
+        for chunk in self.models[tier].generate_content(self._build_prompt(report_text), stream=True):
+            parts.append(chunk.text)
+            yield chunk.text
+        text = "".join(parts).strip()
+        if query is not None:
+            response_cache.add(self.name, query, key, text)
+        self._remember(text, ts)
+
+    def analyze(self, report_text: str, tier: str = "standard", ts: str = None) -> str:
+        # Sync wrapper kept for callers outside an event loop
+        return asyncio.run(self.analyze_async(report_text, tier, ts))
+
 # Orchestrator class
 class MedicalOrchestrator:
+    # Small int ids for agent keys, so history entries are compact tuples
+    _NAMES = ("GeneralPhysician", "Cardiologist", "Pulmonologist", "Psychologist", "Neurologist", "MultidisciplinaryTeam")
+    _AGENT_IDS = {name: i for i, name in enumerate(_NAMES)}
+    __slots__ = ("gp", "cardio", "pulmo", "psych", "neuro", "mdt", "agents", "main_conversation_history", "routing")
+
     def __init__(self):
         # Initialize agents with tailored role prompts
-        self.agents = {
-            "GeneralPhysician": MedicalAgent(
-                "General Physician",
-                "Perform triage: determine likely systems affected (cardiac, neuro, pulmonary, psychiatric, general). Recommend which specialists should review. Keep answer short and explicit."
-            ),
-            "Cardiologist": MedicalAgent(
-                "Cardiologist",
-                "Focus on cardiovascular causes: evaluate chest pain, palpitations, dyspnea, syncope. Recommend tests such as ECG, cardiac enzymes, echo."
-            ),
-            "Pulmonologist": MedicalAgent(
-                "Pulmonologist",
-                "Focus on respiratory causes: evaluate cough, breathlessness, wheeze, hemoptysis. Recommend chest X-ray, spirometry, CT or labs if needed."
-            ),
-            "Psychologist": MedicalAgent(
-                "Psychologist",
-                "Focus on mental health aspects: assess anxiety, depression, somatic symptoms, cognitive change. Suggest screening and red flags for urgent psychiatric referral."
-            ),
-            "Neurologist": MedicalAgent(
-                "Neurologist",
-                "Focus on neurological causes: evaluate headache, dizziness, focal deficits, seizures. Suggest neuro exam elements and imaging if needed."
-            ),
-            "MultidisciplinaryTeam": MedicalAgent(
-                "Multidisciplinary Team",
-                "Synthesize the specialists' outputs into a single, clear final diagnosis and action plan suitable for a clinician. Provide a short summary for patient notes and recommended next steps."
-            ),
-        }
+        self.gp = MedicalAgent(
+            "General Physician",
+            "Perform triage: determine likely systems affected (cardiac, neuro, pulmonary, psychiatric, general). Recommend which specialists should review. Keep answer short and explicit. "
+            "End with exactly one line of the form 'REFER: <comma-separated list from Cardiologist, Pulmonologist, Psychologist, Neurologist>' or 'REFER: None'."
+        )
+        self.cardio = MedicalAgent(
+            "Cardiologist",
+            "Focus on cardiovascular causes: evaluate chest pain, palpitations, dyspnea, syncope. Recommend tests such as ECG, cardiac enzymes, echo."
+        )
+        self.pulmo = MedicalAgent(
+            "Pulmonologist",
+            "Focus on respiratory causes: evaluate cough, breathlessness, wheeze, hemoptysis. Recommend chest X-ray, spirometry, CT or labs if needed."
+        )
+        self.psych = MedicalAgent(
+            "Psychologist",
+            "Focus on mental health aspects: assess anxiety, depression, somatic symptoms, cognitive change. Suggest screening and red flags for urgent psychiatric referral."
+        )
+        self.neuro = MedicalAgent(
+            "Neurologist",
+            "Focus on neurological causes: evaluate headache, dizziness, focal deficits, seizures. Suggest neuro exam elements and imaging if needed."
+        )
+        self.mdt = MedicalAgent(
+            "Multidisciplinary Team",
+            "Synthesize the specialists' outputs into a single, clear final diagnosis and action plan suitable for a clinician. Provide a short summary for patient notes and recommended next steps.",
+            # the synthesis input bundles every specialist answer: rarely repeated and often past the embed input limit
+            use_cache=False,
+        )
+        # Name-keyed read-only view of the same agents, for lookups by specialist name
+        self.agents = MappingProxyType({
+            "GeneralPhysician": self.gp,
+            "Cardiologist": self.cardio,
+            "Pulmonologist": self.pulmo,
+            "Psychologist": self.psych,
+            "Neurologist": self.neuro,
+            "MultidisciplinaryTeam": self.mdt,
+        })
         # A main conversation history (persistent for orchestrator) used for logging
-        self.main_conversation_history = []
+        # entries are (agent_id, time, text); the deque keeps only the latest 100
+        self.main_conversation_history = collections.deque(maxlen=100)
+        # Complexity -> model tier for the specialists (incl. GP) and for the MDT synthesis
+        self.routing = {
+            "trivial": {"specialist": "lite", "mdt": "standard"},
+            "standard": {"specialist": "standard", "mdt": "standard"},
+            "complex": {"specialist": "standard", "mdt": "pro"},
+        }
+
+    def run_full_workflow(self, report_text: str, gp_out: str = None):
+        """Sync wrapper around run_full_workflow_async."""
+        return asyncio.run(self.run_full_workflow_async(report_text, gp_out))
 
-    def run_full_workflow(self, report_text: str):
+    async def run_full_workflow_async(self, report_text: str, gp_out: str = None):
         """
         Run: GP -> specialists -> multidisciplinary synthesis.
+        Specialists are independent of each other, so they are queried concurrently.
+        gp_out: GP triage already obtained (e.g. streamed to the UI); skips the GP call.
         Save detailed log to diagnosis_logs/.
         Return dict of outputs.
         """
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Read the clock once; every agent's memory entry shares this workflow time
+        now = datetime.datetime.now()
+        iso = now.isoformat()
+        timestamp = now.strftime("%Y%m%d_%H%M%S")
         session_id = f"diag_{timestamp}"
+        route = self.routing[_triage_complexity(report_text)]
 
         # 1) General Physician triage
-        gp_out = self.agents["GeneralPhysician"].analyze(report_text)
-        self.main_conversation_history.append({"agent":"GeneralPhysician","text":gp_out,"time":timestamp})
-
-        # 2) Decide which specialists to call.
-        # For thoroughness and to match PDF, we will call all specialists but we could filter down later.
-        cardio_out = self.agents["Cardiologist"].analyze(report_text)
-        self.main_conversation_history.append({"agent":"Cardiologist","text":cardio_out,"time":timestamp})
-
-        pulmon_out = self.agents["Pulmonologist"].analyze(report_text)
-        self.main_conversation_history.append({"agent":"Pulmonologist","text":pulmon_out,"time":timestamp})
+        if gp_out is None:
+            gp_out = await self.gp.analyze_async(report_text, route["specialist"], iso)
+        self.main_conversation_history.append((self._AGENT_IDS["GeneralPhysician"], timestamp, gp_out))
 
-        psych_out = self.agents["Psychologist"].analyze(report_text)
-        self.main_conversation_history.append({"agent":"Psychologist","text":psych_out,"time":timestamp})
-
-        neuro_out = self.agents["Neurologist"].analyze(report_text)
-        self.main_conversation_history.append({"agent":"Neurologist","text":neuro_out,"time":timestamp})
+        # 2) Call only the specialists named on the GP's REFER line (all of them if it is missing).
+        referred = _referred_specialists(gp_out)
+        # Check the semantic cache first, so the report is only uploaded for specialists that will call Gemini
+        probes = await asyncio.gather(*[asyncio.to_thread(self.agents[k].probe_cache, report_text) for k in referred])
+        misses = sum(cached is None for _, _, cached in probes)
+        report_cache = None
+        try:
+            # sharing only pays for the extra upload round trip when at least two specialists send the report
+            if misses >= 2:
+                report_cache = await asyncio.to_thread(_create_report_cache, report_text, route["specialist"])
+            outs = await asyncio.gather(*[
+                self.agents[k].analyze_async(report_text, route["specialist"], iso, report_cache, probe)
+                for k, probe in zip(referred, probes)
+            ])
+        finally:
+            if report_cache is not None:
+                try:
+                    await asyncio.to_thread(report_cache.delete)
+                except Exception:
+                    # the TTL expires it anyway
+                    logger.debug("failed to delete shared report cache", exc_info=True)
+        specialist_outs = dict.fromkeys(SPECIALISTS, NOT_CONSULTED)
+        specialist_outs.update(zip(referred, outs))
+        # History is appended after gather, in a fixed order, so concurrent calls never interleave here
+        for k in referred:
+            self.main_conversation_history.append((self._AGENT_IDS[k], timestamp, specialist_outs[k]))
+        cardio_out = specialist_outs["Cardiologist"]
+        pulmon_out = specialist_outs["Pulmonologist"]
+        psych_out = specialist_outs["Psychologist"]
+        neuro_out = specialist_outs["Neurologist"]
 
         # 3) Multidisciplinary synthesis (use specialist outputs)
-        # Build synthesis prompt including specialists' outputs succinctly
-        synth_input = (
-            f"Patient report:\n{report_text}\n\n"
-            f"GeneralPhysician:\n{gp_out}\n\n"
-            f"Cardiologist:\n{cardio_out}\n\n"
-            f"Pulmonologist:\n{pulmon_out}\n\n"
-            f"Psychologist:\n{psych_out}\n\n"
-            f"Neurologist:\n{neuro_out}\n\n"
-            "Combine the above specialist notes into a concise final diagnosis, recommended tests, urgency, and next steps."
-        )
-        final_out = self.agents["MultidisciplinaryTeam"].analyze(synth_input)
-        self.main_conversation_history.append({"agent":"MultidisciplinaryTeam","text":final_out,"time":timestamp})
+        # Build synthesis prompt including the consulted specialists' outputs succinctly
+        synth_parts = [f"Patient report:\n{report_text}\n\n", f"GeneralPhysician:\n{gp_out}\n\n"]
+        synth_parts.extend(f"{k}:\n{specialist_outs[k]}\n\n" for k in referred)
+        synth_parts.append("Combine the above specialist notes into a concise final diagnosis, recommended tests, urgency, and next steps.")
+        synth_input = "".join(synth_parts)
+        final_out = await self.mdt.analyze_async(synth_input, route["mdt"], iso)
+        self.main_conversation_history.append((self._AGENT_IDS["MultidisciplinaryTeam"], timestamp, final_out))
 
-        # 4) Persist logs (json + txt)
+        # 4) Persist log (JSON only; TXT is rendered from it on demand)
+        # Snapshot first: the orchestrator is shared across Streamlit sessions (threads), and
+        # iterating the deque while another session appends raises RuntimeError
+        history = list(self.main_conversation_history)
         log = {
             "session_id": session_id,
             "timestamp": timestamp,
@@ -151,21 +583,14 @@ class MedicalOrchestrator:
                 "Neurologist": neuro_out,
                 "Final": final_out
             },
-            "conversation_history": self.main_conversation_history[-100:]  # last 100 entries
+            "conversation_history": [
+                {"agent": self._NAMES[i], "text": x, "time": t}
+                for i, t, x in history
+            ]  # last 100 entries
         }
 
-        json_path = LOG_DIR / f"{session_id}.json"
-        txt_path = LOG_DIR / f"{session_id}.txt"
-        with open(json_path, "w", encoding="utf-8") as jf:
-            json.dump(log, jf, ensure_ascii=False, indent=2)
-        with open(txt_path, "w", encoding="utf-8") as tf:
-            tf.write("=== MedAgent Diagnosis Log ===\n")
-            tf.write(f"Session ID: {session_id}\nTimestamp: {timestamp}\n\n")
-            tf.write("=== Report ===\n")
-            tf.write(report_text + "\n\n")
-            for k, v in log["outputs"].items():
-                tf.write(f"--- {k} ---\n")
-                tf.write(v + "\n\n")
+        json_path = f"{LOG_DIR_STR}{session_id}.json"
+        LOG_QUEUE.put((json_path, log))
 
         # Return outputs to UI
         return {
@@ -177,25 +602,21 @@ class MedicalOrchestrator:
             "psych": psych_out,
             "neuro": neuro_out,
             "final": final_out,
-            "log_json": str(json_path),
-            "log_txt": str(txt_path)
+            "log_json": json_path
         }
 
+    def stream_gp(self, report_text: str):
+        """Stream the GP triage so the UI shows text while the specialists run."""
+        route = self.routing[_triage_complexity(report_text)]
+        return self.gp.analyze_stream(report_text, route["specialist"])
+
     def ask_followup(self, agent_key: str, followup_question: str, context_text: str):
         """
         Ask a follow-up question to a specific agent or to the final combined output.
         agent_key: one of 'gp', 'cardio', 'pulmo', 'psych', 'neuro', 'final'
         context_text: the base text to feed (report or agent output)
         """
-        name_map = {
-            "gp": "General Physician",
-            "cardio": "Cardiologist",
-            "pulmo": "Pulmonologist",
-            "psych": "Psychologist",
-            "neuro": "Neurologist",
-            "final": "Multidisciplinary Team"
-        }
-        agent_name = name_map.get(agent_key, "Multidisciplinary Team")
+        agent_name = _AGENT_NAMES.get(agent_key, "Multidisciplinary Team")
         prompt = (
             f"You are {agent_name}. Based on the following context, answer the user's question succinctly.\n\n"
             f"Context:\n{context_text}\n\n"
@@ -206,20 +627,36 @@ class MedicalOrchestrator:
         return response.text.strip()
 
 
-# Provide a simple singleton orchestrator for UI import
-_orch = MedicalOrchestrator()
+# Singleton orchestrator for the module-level wrappers, built on first use so that
+# importing agent (e.g. from app.py, which holds its own) doesn't construct one
+@functools.cache
+def _orch():
+    return MedicalOrchestrator()
 
 def orchestrator_agent(report_text: str):
-    """Wrapper for Streamlit to call a single function."""
-    return (
-        _orch.run_full_workflow(report_text)["gp"],
-        _orch.run_full_workflow(report_text)["cardio"],  # note: run_full_workflow called twice? better to call once - fixed below
-        _orch.run_full_workflow(report_text)["neuro"]
+    """Deprecated wrapper returning (gp, cardio, neuro); use orchestrator_run_full instead."""
+    # warn outside the cache so repeat callers see it too
+    warnings.warn(
+        "orchestrator_agent is deprecated; use orchestrator_run_full",
+        DeprecationWarning,
+        stacklevel=2,
     )
+    return _orchestrator_agent_cached(report_text)
+
+@functools.lru_cache(maxsize=32)
+def _orchestrator_agent_cached(report_text: str):
+    r = _orch().run_full_workflow(report_text)
+    return r["gp"], r["cardio"], r["neuro"]
 
 # Better wrapper that calls once and returns full dict
 def orchestrator_run_full(report_text: str):
-    return _orch.run_full_workflow(report_text)
+    return _orch().run_full_workflow(report_text)
+
+async def orchestrator_run_full_async(report_text: str, gp_out: str = None):
+    return await _orch().run_full_workflow_async(report_text, gp_out)
+
+def orchestrator_stream_gp(report_text: str):
+    return _orch().stream_gp(report_text)
 
 def ask_followup(agent_key: str, followup_question: str, context_text: str):
-    return _orch.ask_followup(agent_key, followup_question, context_text)
+    return _orch().ask_followup(agent_key, followup_question, context_text)
@@ -1,12 +1,32 @@
 # app.py
+import asyncio
 import streamlit as st
-from agent import orchestrator_run_full, ask_followup
-from fpdf import FPDF
+from agent import MedicalOrchestrator, format_log_txt
+from pdf_report import build_pdf
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import datetime
+import json
 import os
 
 st.set_page_config(page_title="MedAgent Multi-Agent Assistant", layout="wide")
 
+# One orchestrator (agents, models, memory) shared across reruns and sessions
+@st.cache_resource
+def get_orchestrator():
+    return MedicalOrchestrator()
+
+orch = get_orchestrator()
+
+# Process pool for CPU-bound PDF rendering, shared across reruns and sessions.
+# Never plain fork: forking this multithreaded, gRPC-initialised process can deadlock children.
+# forkserver where available (POSIX), spawn otherwise (Windows).
+@st.cache_resource
+def get_pdf_pool():
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context(method))
+
 # ---- CSS (ensure readable text on cards) ----
 st.markdown("""
 <style>
@@ -30,7 +50,11 @@ page = st.sidebar.radio("Navigation", ["Report & Analyze", "Follow-up Questions"
 if "last_result" not in st.session_state:
     st.session_state.last_result = None  # store dict returned from orchestrator
 if "recent_sessions" not in st.session_state:
-    st.session_state.recent_sessions = []  # list of session dicts (session_id, timestamp, json_path, text_path)
+    st.session_state.recent_sessions = []  # list of session dicts (session_id, timestamp, json_path)
+if "pdfs" not in st.session_state:
+    st.session_state.pdfs = {}  # session_id -> generated PDF bytes
+if "txts" not in st.session_state:
+    st.session_state.txts = {}  # session_id -> TXT rendered from the JSON log
 
 # ---- Page: Report & Analyze ----
 if page == "Report & Analyze":
@@ -56,14 +80,19 @@ if page == "Report & Analyze":
             report_text = f"Patient: {patient_name}, Age: {patient_age}, Gender: {patient_gender}. Symptoms: {symptoms}"
             st.info("🧠 Running multi-agent analysis — this may take a few seconds.")
             try:
-                result = orchestrator_run_full(report_text)
+                # Stream the GP triage live, then hand it to the workflow for the specialists
+                live = st.empty()
+                with live.container():
+                    st.markdown("<h4>General Physician</h4>", unsafe_allow_html=True)
+                    gp_out = st.write_stream(orch.stream_gp(report_text))
+                result = asyncio.run(orch.run_full_workflow_async(report_text, gp_out.strip()))
+                live.empty()
                 # result includes gp, cardio, pulmo, psych, neuro, final, session ids and log paths
                 st.session_state.last_result = result
                 st.session_state.recent_sessions.insert(0, {
                     "session_id": result["session_id"],
                     "timestamp": result["timestamp"],
-                    "json": result["log_json"],
-                    "txt": result["log_txt"]
+                    "json": result["log_json"]
                 })
                 st.success("Analysis complete — results below.")
             except Exception as e:
@@ -107,7 +136,7 @@ elif page == "Follow-up Questions":
                 st.info("🧠 Agent answering...")
                 context = res['final'] if agent_choice == "final" else res[{"gp":"gp","cardio":"cardio","pulmo":"pulmo","psych":"psych","neuro":"neuro"}[agent_choice]]
                 try:
-                    ans = ask_followup(agent_choice, question, context)
+                    ans = orch.ask_followup(agent_choice, question, context)
                     st.markdown(f"<div class='card-alt'><strong>Answer from {agent_choice.upper()}</strong><p>{ans}</p></div>", unsafe_allow_html=True)
                 except Exception as e:
                     st.error(f"Follow-up error: {e}")
@@ -120,38 +149,17 @@ elif page == "Download Report":
     else:
         res = st.session_state.last_result
         if st.button("Generate & Download PDF"):
-            # Create PDF (strip emojis for safety)
-            pdf = FPDF()
-            pdf.add_page()
-            pdf.set_font("Arial", "B", 14)
-            pdf.cell(200, 10, txt="MedAgent Multi-Agent Diagnosis Report", ln=True, align="C")
-            pdf.ln(6)
-            pdf.set_font("Arial", size=11)
-
-            # safe strings
-            def safe(s):
-                return s.encode('latin-1', 'ignore').decode('latin-1')
-
-            pdf.multi_cell(0, 8, safe(f"Session: {res['session_id']}  |  {res['timestamp']}"))
-            pdf.ln(4)
-            pdf.multi_cell(0, 8, safe("Patient Report:\n" + res.get("report_text", "")))
-            pdf.ln(3)
-            pdf.multi_cell(0, 8, safe("=== General Physician ===\n" + res['gp']))
-            pdf.ln(2)
-            pdf.multi_cell(0, 8, safe("=== Cardiologist ===\n" + res['cardio']))
-            pdf.ln(2)
-            pdf.multi_cell(0, 8, safe("=== Pulmonologist ===\n" + res['pulmo']))
-            pdf.ln(2)
-            pdf.multi_cell(0, 8, safe("=== Psychologist ===\n" + res['psych']))
-            pdf.ln(2)
-            pdf.multi_cell(0, 8, safe("=== Neurologist ===\n" + res['neuro']))
-            pdf.ln(3)
-            pdf.multi_cell(0, 8, safe("=== Final Diagnosis ===\n" + res['final']))
-
-            filename = f"MedAgent_{res['session_id']}.pdf"
-            pdf.output(filename)
-            with open(filename, "rb") as f:
-                st.download_button("Download PDF", data=f, file_name=filename, mime="application/pdf")
+            # Render in a worker process so concurrent users don't contend for the GIL
+            try:
+                data = get_pdf_pool().submit(build_pdf, dict(res)).result()
+            except BrokenProcessPool as e:
+                data = None
+                get_pdf_pool.clear()  # drop the broken pool so the next click starts a fresh one
+                st.error(f"PDF generation failed: {e}")
+            if data is not None:
+                st.session_state.pdfs[res['session_id']] = data
+                filename = f"MedAgent_{res['session_id']}.pdf"
+                st.download_button("Download PDF", data=data, file_name=filename, mime="application/pdf")
 
 # ---- Page: Recent Logs ----
 # ---- Page: Recent Logs ----
@@ -168,18 +176,26 @@ elif page == "Recent Logs":
             
             col1, col2, col3 = st.columns([1,1,1])
             
-            # TXT download
+            # TXT download (rendered from the JSON log only when asked for)
             with col1:
-                if os.path.exists(s['txt']):
-                    with open(s['txt'], "rb") as ftxt:
-                        st.download_button(
-                            label="Download TXT (readable)",
-                            data=ftxt,
-                            file_name=f"{s['session_id']}.txt",
-                            mime="text/plain"
-                        )
-                else:
+                txt = st.session_state.txts.get(s['session_id'])
+                if txt is None and os.path.exists(s['json']):
+                    if st.button("Prepare TXT (readable)", key=f"txt_{s['session_id']}"):
+                        try:
+                            with open(s['json'], "rb") as fjson:
+                                txt = format_log_txt(json.load(fjson))
+                            st.session_state.txts[s['session_id']] = txt
+                        except (OSError, json.JSONDecodeError, KeyError):
+                            st.markdown("TXT not available.")
+                elif txt is None:
                     st.markdown("TXT not available.")
+                if txt is not None:
+                    st.download_button(
+                        label="Download TXT (readable)",
+                        data=txt,
+                        file_name=f"{s['session_id']}.txt",
+                        mime="text/plain"
+                    )
 
             # JSON download
             with col2:
@@ -197,14 +213,13 @@ elif page == "Recent Logs":
             # PDF download
             pdf_filename = f"MedAgent_{s['session_id']}.pdf"
             with col3:
-                if os.path.exists(pdf_filename):
-                    with open(pdf_filename, "rb") as fpdf:
-                        st.download_button(
-                            label="Download PDF (formatted)",
-                            data=fpdf,
-                            file_name=pdf_filename,
-                            mime="application/pdf"
-                        )
+                if s['session_id'] in st.session_state.pdfs:
+                    st.download_button(
+                        label="Download PDF (formatted)",
+                        data=st.session_state.pdfs[s['session_id']],
+                        file_name=pdf_filename,
+                        mime="application/pdf"
+                    )
                 else:
                     st.markdown("PDF not available.")
 
@@ -0,0 +1,42 @@
+# pdf_report.py
+"""
+PDF rendering for MedAgent reports.
+Kept in its own importable module so app.py can run it in worker processes.
+"""
+
+from fpdf import FPDF
+
+
+# safe strings (strip characters latin-1 fonts cannot render, e.g. emojis)
+def safe(s):
+    return s.encode('latin-1', 'ignore').decode('latin-1')
+
+
+def build_pdf(res: dict) -> bytes:
+    """Render a workflow result dict into PDF bytes."""
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Arial", "B", 14)
+    pdf.cell(200, 10, txt="MedAgent Multi-Agent Diagnosis Report", ln=True, align="C")
+    pdf.ln(6)
+    pdf.set_font("Arial", size=11)
+
+    pdf.multi_cell(0, 8, safe(f"Session: {res['session_id']}  |  {res['timestamp']}"))
+    pdf.ln(4)
+    pdf.multi_cell(0, 8, safe("Patient Report:\n" + res.get("report_text", "")))
+    pdf.ln(3)
+    pdf.multi_cell(0, 8, safe("=== General Physician ===\n" + res['gp']))
+    pdf.ln(2)
+    pdf.multi_cell(0, 8, safe("=== Cardiologist ===\n" + res['cardio']))
+    pdf.ln(2)
+    pdf.multi_cell(0, 8, safe("=== Pulmonologist ===\n" + res['pulmo']))
+    pdf.ln(2)
+    pdf.multi_cell(0, 8, safe("=== Psychologist ===\n" + res['psych']))
+    pdf.ln(2)
+    pdf.multi_cell(0, 8, safe("=== Neurologist ===\n" + res['neuro']))
+    pdf.ln(3)
+    pdf.multi_cell(0, 8, safe("=== Final Diagnosis ===\n" + res['final']))
+
+    # Render in memory: pyfpdf returns a latin-1 str, fpdf2 returns a bytearray
+    out = pdf.output(dest="S")
+    return out.encode("latin-1") if isinstance(out, str) else bytes(out)